@@ -1,4 +1,3 @@
-import copy
 import json
 import os
 from functools import partial
@@ -153,13 +152,8 @@ class LLaVADataset(Dataset):
         return len(self.list_data_dict)
 
     def __getitem__(self, i):
-        sources = self.list_data_dict[i]
-        if isinstance(i, int):
-            sources = [sources]
-        assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
-
-        assert 'image' in sources[0]
-        image_file = self.list_data_dict[i]['image']
+        source = self.list_data_dict[i]
+        image_file = source['image']
         image_folder = self.image_root
         try:
             image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
@@ -169,22 +163,17 @@ class LLaVADataset(Dataset):
             crop_size = 256
             image = torch.zeros(3, crop_size, crop_size)
 
-        sources = preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]))
+        # preprocess_multimodal only reassigns sentence['value'], copying the sentence dicts is enough
+        # to keep list_data_dict untouched and much cheaper than a deepcopy
+        sources = preprocess_multimodal([[dict(sentence) for sentence in source["conversations"]]])
 
+        # preprocess_v0 works on a list of conversations, take out the single one of this sample.
+        # Every entry of list_data_dict has an image, samples without one are filtered out in __init__
         data_dict = preprocess_v0(sources, self.tokenizer)
-
-        if isinstance(i, int):
-            data_dict = dict(input_ids=data_dict["input_ids"][0],
-                             labels=data_dict["labels"][0],
-                             input_ids_system=data_dict["input_ids_system"][0])
-
-        # image exist in the data
-        if 'image' in self.list_data_dict[i]:
-            data_dict['image'] = image
-        else:
-            # image does not exist in the data, but the model is multimodal
-            crop_size = 256
-            data_dict['image'] = torch.zeros(3, crop_size, crop_size)
+        data_dict = dict(input_ids=data_dict["input_ids"][0],
+                         labels=data_dict["labels"][0],
+                         input_ids_system=data_dict["input_ids_system"][0],
+                         image=image)
 
         return data_dict
 
@@ -1,112 +1,261 @@
-import copy
+import itertools
 import json
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 from PIL import Image
+from pyarrow import feather
 from llava.llava import conversation as conversation_lib
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, default_collate
 from torch.utils.data.distributed import DistributedSampler
-from transformers import CLIPImageProcessor
+from torchvision.io import ImageReadMode, decode_image, read_file
+from torchvision.transforms import v2
 
 DEFAULT_IMAGE_TOKEN = "<image>"
 IGNORE_INDEX = -100
+# image pre-processing settings of openai/clip-vit-large-patch14-336
+CLIP_IMAGE_SIZE = 336
+CLIP_IMAGE_MEAN = (0.48145466, 0.4578275, 0.40821073)
+CLIP_IMAGE_STD = (0.26862954, 0.26130258, 0.27577711)
+# bump whenever load_image or center_crop_resize change the cached pixels
+IMAGE_CACHE_VERSION = 1
 conversation_lib.default_conversation = conversation_lib.conv_templates["plain"]
 
-def preprocess_multimodal(sources):
-    for source in sources:
-        for sentence in source:
-            if DEFAULT_IMAGE_TOKEN in sentence['value']:
-                sentence['value'] = sentence['value'].replace(DEFAULT_IMAGE_TOKEN, '').strip()
-                sentence['value'] = DEFAULT_IMAGE_TOKEN + '\n' + sentence['value']
-                sentence['value'] = sentence['value'].strip()
-
-                # Customized operation, get rid of <image> special token. Edited by Zechen
-                sentence["value"] = sentence["value"].replace(DEFAULT_IMAGE_TOKEN, "")
-                sentence['value'] = sentence['value'].strip()
-
-    return sources
-
-
-def preprocess_plain(sources, tokenizer):
-    # add end signal and concatenate together
-    conversations = []
-    for source in sources:
-        assert len(source) == 2
-        # assert DEFAULT_IMAGE_TOKEN in source[0]['value']
-        # source[0]['value'] = DEFAULT_IMAGE_TOKEN
-        source[0]['value'] = ""
-        conversation = source[0]['value'] + source[1]['value'] + conversation_lib.default_conversation.sep
-        conversations.append(conversation)
-
-    # tokenize conversations
-    # input_ids = [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations]
-    input_ids = [tokenizer(prompt)["input_ids"] + [tokenizer.eos_token_id] for prompt in conversations]
-    targets = copy.deepcopy(input_ids)
+def preprocess_caption(caption):
+    # only the caption survives the plain template, so it is the only sentence which needs the
+    # customized operation to get rid of <image> special token. Edited by Zechen
+    if DEFAULT_IMAGE_TOKEN in caption:
+        caption = caption.replace(DEFAULT_IMAGE_TOKEN, '').strip()
+    return caption
+
 
-    for target, source in zip(targets, sources):
-        # tokenized_len = len(tokenizer_image_token(source[0]['value'], tokenizer))
-        tokenized_len = len(tokenizer(source[0]['value'])["input_ids"])
-        if tokenized_len > 0:
-            target[:tokenized_len] = IGNORE_INDEX
+def preprocess_plain(captions, tokenizer):
+    # the prompt part of the plain template is always empty, just add end signal to the captions
+    conversations = [caption + conversation_lib.default_conversation.sep for caption in captions]
 
-    return dict(input_ids=torch.tensor(input_ids), labels=torch.tensor(targets))
+    # tokenize all conversations in one batched call, fast tokenizers encode the whole list in parallel
+    # in Rust, a slow python tokenizer would loop over the 558k captions one by one
+    assert tokenizer.is_fast, "Pre-tokenizing the llava captions requires a fast tokenizer"
+    # input_ids = [tokenizer_image_token(prompt, tokenizer, return_tensors='pt') for prompt in conversations]
+    input_ids = tokenizer(conversations, padding=False, return_attention_mask=False)["input_ids"]
+
+    # pack all sequences plus their eos token into one preallocated long array, sample i is
+    # packed_ids[offsets[i]:offsets[i + 1]]. Two tensors instead of one tensor object per caption, so
+    # forked workers do not touch (and copy) per-sample objects when indexing
+    eos = [tokenizer.eos_token_id]
+    lengths = [len(ids) + 1 for ids in input_ids]
+    packed_ids = torch.from_numpy(np.fromiter(itertools.chain.from_iterable(ids + eos for ids in input_ids),
+                                              dtype=np.int64, count=sum(lengths)))
+    offsets = torch.zeros(len(lengths) + 1, dtype=torch.long)
+    offsets[1:] = torch.as_tensor(lengths, dtype=torch.long).cumsum(0)
+
+    # nothing has to be masked in the targets, labels are just a copy of input_ids
+    return packed_ids, offsets
+
+
+def get_source_metadata(data_file_path):
+    # identifies the json (and the caption cleanup) an arrow file was converted from, bump the version
+    # whenever preprocess_caption changes
+    stat = os.stat(data_file_path)
+    return {
+        b"source_mtime_ns": str(stat.st_mtime_ns).encode(),
+        b"source_size": str(stat.st_size).encode(),
+        b"caption_version": b"1",
+    }
+
+
+def get_tmp_file_path(file_path):
+    # ranks on different nodes write next to each other on the shared mount and may share a pid, so the
+    # temporary file gets a random name before it is moved in place atomically
+    return f"{file_path}.{uuid.uuid4().hex}.tmp"
+
+
+def convert_to_arrow(data_file_path, arrow_file_path):
+    """Packs the image paths and captions of the llava json annotations into an uncompressed arrow file,
+    which can be memory-mapped and shared by all dataloader workers."""
+    with open(data_file_path, 'r') as f:
+        data = [item for item in json.load(f) if 'image' in item.keys()]
+    table = pa.table({
+        "image": [item["image"] for item in data],
+        "caption": [preprocess_caption(item["conversations"][1]["value"]) for item in data],
+    }, metadata=get_source_metadata(data_file_path))
+
+    # every rank may run the conversion, write to a private file first and move it in place atomically
+    tmp_file_path = get_tmp_file_path(arrow_file_path)
+    feather.write_feather(table, tmp_file_path, compression="uncompressed")
+    os.replace(tmp_file_path, arrow_file_path)
+
+
+def read_annotations(data_file_path, arrow_file_path):
+    """Memory-maps the arrow annotations, (re-)converting the json first when the arrow file is missing or
+    was converted from a different version of the json."""
+    if os.path.exists(arrow_file_path):
+        table = feather.read_table(arrow_file_path, memory_map=True)
+        metadata = table.schema.metadata or {}
+        if all(metadata.get(k) == v for k, v in get_source_metadata(data_file_path).items()):
+            return table
+        print(f"{arrow_file_path} is out of date, converting {data_file_path} again")
+
+    convert_to_arrow(data_file_path, arrow_file_path)
+    return feather.read_table(arrow_file_path, memory_map=True)
+
+
+def load_image(image_path):
+    try:
+        # decode with libjpeg-turbo straight into a (3, H, W) uint8 tensor, no PIL image in between
+        return decode_image(read_file(image_path), mode=ImageReadMode.RGB)
+    except RuntimeError:
+        # fall back to PIL for the files torchvision cannot decode (e.g. CMYK jpegs or other formats)
+        image = Image.open(image_path)
+        # convert() returns a full-frame copy even when the mode already matches
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        # np.asarray aliases the buffer exported by PIL, v2.PILToTensor would copy it once more. It is
+        # read-only, which is fine since the resize only reads it, and the HWC -> CHW permute is a view
+        return torch.from_numpy(np.asarray(image)).permute(2, 0, 1)
+
+
+def center_crop_resize(image, size):
+    # same resize and crop as the CLIPImageProcessor of the vision tower, but the central square is cropped
+    # first (a view) so the bicubic kernel only processes pixels which are kept and directly writes the
+    # final size x size buffer. The resize runs on uint8 tensors (SIMD kernel in torchvision) and images
+    # stay uint8, see normalize_images
+    crop_size = min(image.shape[-2:])
+    image = v2.functional.center_crop(image, [crop_size, crop_size])
+    return v2.functional.resize(image, [size, size], interpolation=v2.InterpolationMode.BICUBIC, antialias=True)
 
 
 class LLaVAPretrainCaptioningDataset(Dataset):
 
-    def __init__(self, tokenizer):
+    def __init__(self, tokenizer, num_decode_threads=4):
         super(LLaVAPretrainCaptioningDataset, self).__init__()
 
         self.tokenizer = tokenizer
+        self.num_decode_threads = num_decode_threads
 
         data_file_path = "/mnt/bn/vgfm2/test_dit/blip_laion_cc_sbu_558k.json"
+        self.data_file_path = data_file_path
         self.image_root = "/mnt/bn/vgfm2/test_dit/pretraining_data"
 
-        with open(data_file_path, 'r') as f:
-            data = json.load(f)
-        self.list_data_dict = []
-        for item in data:
-            if 'image' in item.keys():
-                self.list_data_dict.append(item)
-
-        self.processor = CLIPImageProcessor.from_pretrained("openai/clip-vit-large-patch14-336")
+        # memory-mapped and zero-copy, so workers read the same physical pages instead of each holding
+        # its own copy of 558k python dicts
+        self.table = read_annotations(data_file_path, os.path.splitext(data_file_path)[0] + ".arrow")
+        # join the image root once for all samples. Kept as an arrow array rather than a python list so the
+        # workers keep sharing its pages
+        self.image_paths = pc.binary_join_element_wise(self.image_root, self.table["image"], os.sep)
+
+        self.image_mean = CLIP_IMAGE_MEAN
+        self.image_std = CLIP_IMAGE_STD
+
+        # image pre-processing is deterministic, so once build_image_cache has been run images are
+        # read from a flat uint8 file instead of being decoded and resized again every epoch. The file name
+        # carries IMAGE_CACHE_VERSION so that a cache built with an older pre-processing is never picked up
+        self.image_cache_path = (os.path.splitext(data_file_path)[0]
+                                 + f"_{CLIP_IMAGE_SIZE}px_v{IMAGE_CACHE_VERSION}.bin")
+        # the rows of the cache are only aligned with the captions of the json it was built from, which is
+        # recorded next to it in the same way as in the arrow annotations
+        self.image_cache_metadata_path = self.image_cache_path + ".json"
+        self.use_image_cache = os.path.exists(self.image_cache_path)
+        self.image_cache = None
+        if self.use_image_cache:
+            expected_size = len(self) * 3 * CLIP_IMAGE_SIZE ** 2
+            cache_size = os.path.getsize(self.image_cache_path)
+            if cache_size != expected_size:
+                raise ValueError(f"Image cache {self.image_cache_path} has {cache_size} bytes but {expected_size} are "
+                                 f"expected for {len(self)} images, it was built for different annotations. "
+                                 f"Delete it and run build_image_cache again.")
+
+            metadata = {}
+            if os.path.exists(self.image_cache_metadata_path):
+                with open(self.image_cache_metadata_path, 'r') as f:
+                    metadata = json.load(f)
+            if not all(metadata.get(k.decode()) == v.decode()
+                       for k, v in get_source_metadata(data_file_path).items()):
+                raise ValueError(f"Image cache {self.image_cache_path} was not built from the current "
+                                 f"{data_file_path}, its rows may not match the captions anymore. "
+                                 f"Delete it and run build_image_cache again.")
 
         print("Formatting llava captioning data")
+        # tokenize every caption once here instead of on each __getitem__ call
+        self.packed_ids, self.offsets = preprocess_plain(self.table["caption"].to_pylist(), tokenizer)
 
     def __len__(self):
-        return len(self.list_data_dict)
+        return self.table.num_rows
+
+    def get_image(self, i):
+        if not self.use_image_cache:
+            image = load_image(self.image_paths[i].as_py())
+            return center_crop_resize(image, CLIP_IMAGE_SIZE)
+
+        if self.image_cache is None:
+            # mapped lazily so that every worker maps the file itself and all of them share the page cache.
+            # Copy-on-write mode keeps the array writable for torch.from_numpy, the file is never modified
+            self.image_cache = np.memmap(self.image_cache_path, dtype=np.uint8, mode='c',
+                                         shape=(len(self), 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))
+        return torch.from_numpy(self.image_cache[i])
 
     def __getitem__(self, i):
-        sources = self.list_data_dict[i]
-        if isinstance(i, int):
-            sources = [sources]
-        assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
+        image = self.get_image(i)
 
-        assert 'image' in sources[0]
-        image_file = self.list_data_dict[i]['image']
-        image_folder = self.image_root
-        image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
-        image = self.processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+        input_ids = self.packed_ids[self.offsets[i]:self.offsets[i + 1]]
+        data_dict = dict(input_ids=input_ids, labels=input_ids.clone(), image=image)
 
-        sources = preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]))
+        return data_dict
 
-        data_dict = preprocess_plain(sources, self.tokenizer)
+    def __getitems__(self, indices):
+        # the DataLoader hands over all indices of a batch at once. File reads and image decoding release
+        # the GIL, so a few threads per worker load the images of the batch concurrently
+        if self.use_image_cache or self.num_decode_threads <= 1:
+            return [self[i] for i in indices]
+        with ThreadPoolExecutor(max_workers=self.num_decode_threads) as executor:
+            return list(executor.map(self.__getitem__, indices))
 
-        if isinstance(i, int):
-            data_dict = dict(input_ids=data_dict["input_ids"][0],
-                             labels=data_dict["labels"][0])
 
-        # image exist in the data
-        if 'image' in self.list_data_dict[i]:
-            data_dict['image'] = image
-        else:
-            # image does not exist in the data, but the model is multimodal
-            crop_size = 256
-            data_dict['image'] = torch.zeros(3, crop_size, crop_size)
+def build_image_cache(dataset, num_workers=32, batch_size=64):
+    """Pre-processes every image of a LLaVAPretrainCaptioningDataset once and writes the uint8 results to
+    dataset.image_cache_path, a flat file of shape (N, 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE).
 
-        return data_dict
+    Run it with `python3 -m llava.llava_pretrain_data --build_image_cache`."""
+    assert not dataset.use_image_cache, f"{dataset.image_cache_path} already exists"
+
+    tmp_file_path = get_tmp_file_path(dataset.image_cache_path)
+    image_cache = np.memmap(tmp_file_path, dtype=np.uint8, mode='w+',
+                            shape=(len(dataset), 3, CLIP_IMAGE_SIZE, CLIP_IMAGE_SIZE))
+    dataloader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=partial(collate_fn, tokenizer=dataset.tokenizer),
+    )
+    start = 0
+    for batch in dataloader:
+        image_cache[start:start + len(batch['images'])] = batch['images'].numpy()
+        start += len(batch['images'])
+    image_cache.flush()
+    del image_cache
+
+    # record which annotations the rows belong to before the cache itself is moved in place
+    metadata = {k.decode(): v.decode() for k, v in get_source_metadata(dataset.data_file_path).items()}
+    tmp_metadata_path = get_tmp_file_path(dataset.image_cache_metadata_path)
+    with open(tmp_metadata_path, 'w') as f:
+        json.dump(metadata, f)
+    os.replace(tmp_metadata_path, dataset.image_cache_metadata_path)
+    os.replace(tmp_file_path, dataset.image_cache_path)
+    dataset.use_image_cache = True
+
+
+def normalize_images(images, image_mean, image_std):
+    # images are shipped through the dataloader as uint8 (4x less host memory and PCIe traffic than
+    # float32), cast and normalize them after they have been moved to the gpu
+    mean = torch.as_tensor(image_mean, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    std = torch.as_tensor(image_std, dtype=torch.float32, device=images.device).view(1, -1, 1, 1)
+    return images.to(torch.float32).div_(255).sub_(mean).div_(std)
 
 
 def collate_fn(
@@ -114,41 +263,26 @@ def collate_fn(
         tokenizer=None,
         max_length=77,
 ):
-    input_ids, labels = tuple([instance[key] for instance in instances]
-                              for key in ("input_ids", "labels"))
-    input_ids = torch.nn.utils.rnn.pad_sequence(
-        input_ids,
-        batch_first=True,
-        padding_value=tokenizer.pad_token_id)
-    labels = torch.nn.utils.rnn.pad_sequence(labels,
-                                             batch_first=True,
-                                             padding_value=IGNORE_INDEX)
-
-    if input_ids.shape[-1] < max_length:
-        offset = max_length - input_ids.shape[-1]
-        pad_tube = torch.ones(size=(input_ids.shape[0], offset), dtype=input_ids.dtype) * tokenizer.pad_token_id
-        input_ids = torch.cat([input_ids, pad_tube], dim=1)
-
-        offset = max_length - labels.shape[-1]
-        pad_tube = torch.ones(size=(labels.shape[0], offset), dtype=labels.dtype) * IGNORE_INDEX
-        labels = torch.cat([labels, pad_tube], dim=1)
-
     min_max_len = min(max_length, tokenizer.model_max_length)
 
-    input_ids = input_ids[:, :min_max_len]
-    labels = labels[:, :min_max_len]
+    # fill a preallocated padded batch instead of pad_sequence + padding tube + cat
+    input_ids = torch.full((len(instances), min_max_len), tokenizer.pad_token_id, dtype=torch.long)
+    labels = torch.full((len(instances), min_max_len), IGNORE_INDEX, dtype=torch.long)
+    for i, instance in enumerate(instances):
+        length = min(len(instance["input_ids"]), min_max_len)
+        input_ids[i, :length] = instance["input_ids"][:length]
+        labels[i, :length] = instance["labels"][:length]
+
     batch = dict(
         input_ids=input_ids,
         labels=labels,
         attention_mask=input_ids.ne(tokenizer.pad_token_id),
     )
 
-    if 'image' in instances[0]:
-        images = [instance['image'] for instance in instances]
-        if all(x is not None and x.shape == images[0].shape for x in images):
-            batch['images'] = torch.stack(images)
-        else:
-            batch['images'] = images
+    # every sample has an image cropped and resized to CLIP_IMAGE_SIZE, so they can always be stacked.
+    # default_collate stacks straight into shared memory inside a worker, so the batch is not copied once
+    # more when it is sent back to the main process to be pinned
+    batch['images'] = default_collate([instance['image'] for instance in instances])
 
     return batch
 
@@ -160,15 +294,20 @@ def get_plain_data_loader(
         world_size,
         local_rank,
         max_length,
+        prefetch_factor=4,
 ):
     train_dataset = LLaVAPretrainCaptioningDataset(tokenizer)
     datasampler = DistributedSampler(train_dataset, num_replicas=world_size, rank=local_rank)
+    # keep the workers (and their dataset copies) alive across epochs. prefetch_factor is per worker,
+    # so num_workers * prefetch_factor batches are in flight in total
     dataloader = torch.utils.data.DataLoader(
         train_dataset,
         batch_size=batch_size,
         drop_last=True,
         num_workers=num_workers,
         pin_memory=True,
+        persistent_workers=num_workers > 0,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
         collate_fn=partial(
             collate_fn,
             tokenizer=tokenizer,
@@ -181,7 +320,13 @@ def get_plain_data_loader(
 
 
 if __name__ == '__main__':
+    import argparse
     import transformers
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--build_image_cache", action="store_true")
+    parser.add_argument("--num_workers", type=int, default=32)
+    args = parser.parse_args()
+
     pretrained_model_path = '/mnt/bn/vgfm2/test_mlx/xavier/pretrained_weights/phi-1_5'
     tokenizer = transformers.AutoTokenizer.from_pretrained(pretrained_model_path,
                                                            padding_side="left")
@@ -191,5 +336,7 @@ if __name__ == '__main__':
 
     dataset = LLaVAPretrainCaptioningDataset(tokenizer)
 
+    if args.build_image_cache:
+        build_image_cache(dataset, num_workers=args.num_workers)
     dataset.__getitem__(0)
 
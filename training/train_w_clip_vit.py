@@ -338,7 +338,7 @@ def main():
 
     # Data for llava instructional tuning, 576 is the number of feature vectors extracted from CLIP-ViT(336px)
     if config.dataset.und_type == "llava_pretrain":
-        from llava.llava_pretrain_data import get_plain_data_loader
+        from llava.llava_pretrain_data import get_plain_data_loader, normalize_images
         train_dataloader_mmu = get_plain_data_loader(
             tokenizer,
             batch_size=config.training.batch_size_mmu,
@@ -347,6 +347,8 @@ def main():
             local_rank=accelerator.process_index,
             max_length=preproc_config.max_seq_length - (576 - config.model.showo.num_vq_tokens),
         )
+        mmu_image_mean = train_dataloader_mmu.dataset.image_mean
+        mmu_image_std = train_dataloader_mmu.dataset.image_std
         SYSTEM_PROMPT_LEN = 0
 
     elif config.dataset.und_type == "llava_tuning":
@@ -515,6 +517,7 @@ def main():
                                                                batch["mmu_flow"]["labels"])
 
                 pixel_values_mmu = pixel_values_mmu.to(accelerator.device, non_blocking=True)
+                pixel_values_mmu = normalize_images(pixel_values_mmu, mmu_image_mean, mmu_image_std)
                 input_ids_mmu = input_ids_mmu.to(accelerator.device, non_blocking=True)
 
                 input_ids_mmu = torch.cat([
@@ -545,7 +548,7 @@ def main():
                     (torch.ones(input_ids_mmu.shape[0], 1) * uni_prompting.ignore_id).to(accelerator.device),
                     torch.ones_like(images_embeddings[:, :, 0]) * uni_prompting.ignore_id,
                     (torch.ones(input_ids_mmu.shape[0], 1) * uni_prompting.ignore_id).to(accelerator.device),
-                    labels_mmu.to(accelerator.device)
+                    labels_mmu.to(accelerator.device, non_blocking=True)
                 ], dim=1).long()
 
             elif config.dataset.und_type == "llava_tuning":